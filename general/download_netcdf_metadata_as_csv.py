@@ -1,30 +1,54 @@
 import netCDF4 as nc
 import csv
+import io
+import os
+from itertools import chain
 from pathlib import Path
 from argparse import ArgumentParser
 
-def main(file):
 
-    rootgrp = nc.Dataset(file)
-    metadata = []
-    for i in rootgrp.ncattrs(): 
-        metadata.append((i, getattr(rootgrp, i), 'ncattrs'))
-    for i in rootgrp.dimensions:
-        metadata.append((i, rootgrp.dimensions[i].size, 'dimensions'))
-    for i in rootgrp.variables:
-        metadata.append((i, rootgrp.variables[i].long_name, 'variables'))
+def format_rows(rows):
+    """Format rows as CSV text in memory, so the file can be written at once"""
+
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    return buffer.getvalue()
+
+
+def write_file(filename, data):
+    """Write bytes to a file, in a single system call when possible"""
 
+    fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        view = memoryview(data)
+        while view:
+            # os.write can write fewer bytes than requested
+            written = os.write(fd, view)
+            view = view[written:]
+    finally:
+        os.close(fd)
+
+
+def main(file):
 
     filename_without_extension = Path(file).stem
     csv_filename = f"{filename_without_extension}_metadata.csv"
 
-    with open(csv_filename, "w") as file:
-        writer = csv.writer(file)
+    # no variable data is read, so the HDF5 chunk cache would only take up memory
+    nc.set_chunk_cache(size=0)
+    with nc.Dataset(file, mode="r") as rootgrp:
+        # only metadata is read, so skip setting up masking/scaling of variables
+        rootgrp.set_auto_maskandscale(False)
+        # rows are produced while formatting, instead of collecting them in a list first
+        metadata = chain(
+            ((n, rootgrp.getncattr(n), 'ncattrs') for n in rootgrp.ncattrs()),
+            ((n, d.size, 'dimensions') for n, d in rootgrp.dimensions.items()),
+            ((n, getattr(v, 'long_name', ''), 'variables') for n, v in rootgrp.variables.items()),
+        )
         header = ["attribute", "value", "origin"]
-        writer.writerow(header)
-        for element in metadata:
-            data = [element[0],element[1],element[2]]
-            writer.writerow(data)
+        data = format_rows(chain([header], metadata)).encode("utf-8")
+
+    write_file(csv_filename, data)
 
 if __name__ == "__main__":
     # Handling commandline arguments
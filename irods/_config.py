@@ -0,0 +1,68 @@
+"""Configuration shared by the iRODS scripts, resolved once per process"""
+
+import functools
+import json
+import os
+import ssl
+
+DEFAULT_ENV_FILE = os.path.expanduser("~/.irods/irods_environment.json")
+PRC_ENV_FILE = os.path.expanduser("~/.irods/irods_environment_prc.json")
+
+# set when the user points to an environment file explicitly
+ENV_FILE = os.environ.get("IRODS_ENVIRONMENT_FILE")
+
+
+def get_env_file(default=DEFAULT_ENV_FILE):
+    """Return the path of the iRODS environment file
+
+    The IRODS_ENVIRONMENT_FILE environment variable takes precedence over the default.
+    """
+
+    return ENV_FILE or default
+
+
+@functools.lru_cache(maxsize=None)
+def get_ssl_context(cafile=None, capath=None, verify_server="hostname"):
+    """
+    Create the SSL context once per set of settings;
+    loading the CA bundle is relatively slow
+
+    Without a CA file or path, the system's CA store is used.
+    verify_server follows irods_ssl_verify_server: 'hostname' checks
+    the certificate and the host name, 'cert' only the certificate
+    and 'none' nothing.
+    """
+
+    context = ssl.create_default_context(
+        purpose=ssl.Purpose.SERVER_AUTH, cafile=cafile, capath=capath, cadata=None
+    )
+    # check_hostname must be turned off before verify_mode can be lowered
+    context.check_hostname = verify_server == "hostname"
+    if verify_server == "none":
+        context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+def get_ssl_settings(env_file):
+    """
+    Return the SSL settings to create a session with
+
+    No SSL context is created when the environment file
+    refuses SSL connections. Otherwise the context uses the CA certificate
+    and verification level of the environment file, like python-irodsclient
+    does when it creates the context itself.
+    """
+
+    try:
+        with open(env_file) as file:
+            env = json.load(file)
+    except (OSError, ValueError):
+        env = {}
+    if env.get("irods_client_server_policy") == "CS_NEG_REFUSE":
+        return {}
+    context = get_ssl_context(
+        cafile=env.get("irods_ssl_ca_certificate_file"),
+        capath=env.get("irods_ssl_ca_certificate_path"),
+        verify_server=env.get("irods_ssl_verify_server", "hostname"),
+    )
+    return {"ssl_context": context}
@@ -0,0 +1,55 @@
+"""Create the iRODS session used by the scripts in this directory"""
+
+import functools
+from irods.session import iRODSSession
+from _config import DEFAULT_ENV_FILE, get_env_file, get_ssl_settings
+
+
+@functools.lru_cache(maxsize=1)
+def _cached_session(env_file):
+    ssl_settings = get_ssl_settings(env_file)
+    return iRODSSession(irods_env_file=env_file, **ssl_settings)
+
+
+def make_session(default_env_file=DEFAULT_ENV_FILE):
+    """
+    Get an iRODS session
+
+    The session is created on the first call and reused on later calls
+    within the same process, so the connections in its pool (and the
+    authentication done on them) are shared.
+    The session can be used as a context manager.
+
+    Arguments
+    ---------
+    default_env_file: str
+        The environment file to use when IRODS_ENVIRONMENT_FILE is not set
+
+    Returns
+    -------
+    session: iRODSSession
+        An iRODSSession object
+    """
+
+    return _cached_session(get_env_file(default_env_file))
+
+
+def warm_up_pool(session, connections):
+    """
+    Open connections in the pool of a session before they're needed
+
+    The connections are returned to the pool idle, so workers that use
+    the session concurrently find an authenticated connection waiting.
+
+    Arguments
+    ---------
+    session: iRODSSession
+        An iRODSSession object
+
+    connections: int
+        The number of connections to open
+    """
+
+    opened = [session.pool.get_connection() for _ in range(connections)]
+    for connection in opened:
+        connection.release()
@@ -1,22 +1,10 @@
 """A simple script to test whether you can connect to iRODS"""
 
-import os
-import ssl
-from irods.session import iRODSSession
-
-# Create an iRODS session
-try:
-    env_file = os.environ['IRODS_ENVIRONMENT_FILE']
-except KeyError:
-    env_file = os.path.expanduser('~/.irods/irods_environment.json')
-ssl_context = ssl.create_default_context(purpose=ssl.Purpose.SERVER_AUTH,
-                                             cafile=None,
-                                             capath=None,
-                                             cadata=None)
-ssl_settings = {'ssl_context': ssl_context}
+from _session import make_session
 
 try: 
-    with iRODSSession(irods_env_file=env_file, **ssl_settings) as session:
+    # Create an iRODS session
+    with make_session() as session:
         zone = session.zone
         home = f"/{zone}/home"
         coll = session.collections.get(home)
@@ -1,11 +1,10 @@
 """Write metadata on an object to CSV"""
 
-import os
 from pathlib import Path
-import ssl
 import csv
 from argparse import ArgumentParser
-from irods.session import iRODSSession
+from _config import PRC_ENV_FILE
+from _session import make_session
 
 
 def main(session, path):
@@ -17,14 +16,11 @@ def main(session, path):
     do_without_extension = Path(path).stem
     csv_filename = f"{do_without_extension}_metadata.csv"
 
-    with open(csv_filename, "w") as file:
-        writer = csv.writer(file)
+    with open(csv_filename, "w", newline="", buffering=1 << 20) as out:
+        writer = csv.writer(out)
         header = ["attribute","value","units"]
         writer.writerow(header)
-        for avu in metadata:
-            data = [avu.name, avu.value, avu.units]
-            writer.writerow(data)
-            
+        writer.writerows((avu.name, avu.value, avu.units) for avu in metadata)
 
 
 if __name__ == "__main__":
@@ -33,9 +29,5 @@ if __name__ == "__main__":
     parser.add_argument(dest="path", help="The path to the data object")
     args = parser.parse_args()
 
-    try:
-        env_file = os.environ["IRODS_ENVIRONMENT_FILE"]
-    except KeyError:
-        env_file = os.path.expanduser("~/.irods/irods_environment_prc.json")
-    with iRODSSession(irods_env_file=env_file) as session:
+    with make_session(PRC_ENV_FILE) as session:
         main(session, args.path)
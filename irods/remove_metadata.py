@@ -1,60 +1,208 @@
 """Remove all metadata from an object"""
-import os
-import ssl
+import posixpath
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 from irods.exception import CollectionDoesNotExist, DataObjectDoesNotExist
 from irods.meta import iRODSMeta, AVUOperation
-from irods.session import iRODSSession
 from irods.models import DataObject, DataObjectMeta, Collection, CollectionMeta 
 from irods.column import Criterion
+from _config import PRC_ENV_FILE
+from _session import make_session
 
+# Maximum number of AVU operations sent in a single atomic request
+OPERATIONS_PER_REQUEST = 500
 
-def remove_all_avus(Object, prefix=None, verbose=False):
-    
+
+def batched(iterable, n):
+    """Split an iterable into lists of at most n items"""
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, n)):
+        yield chunk
+
+def remove_avus(session, model, path, avus, verbose=False):
+
+    if not avus:
+        # nothing to remove, so don't send an empty request
+        return
+    operations = [AVUOperation(operation="remove", avu=i) for i in avus]
     if verbose:
-        print(f"Removing metadata from {Object.path}")
-    avus_on_Object = Object.metadata.items()
-    if prefix == None:
-        avus_to_remove = avus_on_Object 
+        print(f"Removing {len(operations)} AVUs from {path}")
+    # keep requests bounded in size for objects with very many AVUs
+    for chunk in batched(operations, OPERATIONS_PER_REQUEST):
+        # only the path is needed, so the object itself doesn't have to be fetched
+        session.metadata.apply_atomic_operations(model, path, *chunk)
+
+def filter_avus(avus, prefixes=None):
+    if not prefixes:
+        return avus
+    # startswith checks all prefixes in one call when given a tuple
+    prefixes = tuple(prefixes)
+    return [avu for avu in avus if avu.name.startswith(prefixes)]
+
+def prefix_criteria(meta_model, prefixes=None):
+    """Criteria that make the catalog only return AVUs starting with the prefix
+
+    This is only possible for a single prefix, since the criteria can't be OR'ed.
+    Underscores in the prefix act as a wildcard in 'like',
+    so results still need to go through filter_avus.
+    """
+    if not prefixes or len(prefixes) > 1:
+        return []
+    return [Criterion('like', meta_model.name, prefixes[0] + '%')]
+
+def list_avus(session, model, path, prefixes=None):
+    """Fetch the AVUs on a single data object or collection
+
+    Only the attribute name, value and units are queried.
+    """
+    if model == DataObject:
+        meta_model = DataObjectMeta
+        criteria = [
+            Criterion('=', Collection.name, posixpath.dirname(path)),
+            Criterion('=', DataObject.name, posixpath.basename(path)),
+        ]
     else:
-        avus_to_remove =  [avu for avu in avus_on_Object if avu.name.startswith(prefix)]
-    Object.metadata.apply_atomic_operations(
-        *[AVUOperation(operation="remove", avu=i) for i in avus_to_remove]
-    )
+        meta_model = CollectionMeta
+        criteria = [Criterion('=', Collection.name, path)]
+    query = session.query(meta_model.name, meta_model.value, meta_model.units)
+    query = query.filter(*criteria, *prefix_criteria(meta_model, prefixes))
+    avus = [
+        iRODSMeta(result[meta_model.name], result[meta_model.value], result[meta_model.units])
+        for result in query
+    ]
+    return filter_avus(avus, prefixes)
+
+def remove_all_avus(session, model, Object, prefixes=None, verbose=False):
+    
+    avus_to_remove = list_avus(session, model, Object.path, prefixes)
+    remove_avus(session, model, Object.path, avus_to_remove, verbose)
+
+def remove_avus_concurrently(session, model, avus_per_path, prefixes=None, verbose=False, max_workers=8):
+    """Remove AVUs from many objects using a pool of threads
+
+    Arguments
+    ---------
+    session: iRODSSession
+        An iRODSSession object
+    model: class
+        DataObject or Collection, depending on the type of the paths
+    avus_per_path: dict
+        Dictionary mapping paths to the AVUs on that path
+    prefixes: list
+        Only AVUs with an attribute name starting with one of the prefixes are removed
+    verbose: bool
+        Verbose mode
+    max_workers: int
+        Number of threads. The session hands every thread its own connection.
+    """
+
+    def remove(path, avus):
+        remove_avus(session, model, path, filter_avus(avus, prefixes), verbose)
 
-def list_data_objects_with_metadata(session, path, verbose=False):
-    query = session.query(DataObjectMeta.name, DataObject.name, Collection.name)
-    query.filter(Criterion('like', Collection.name, path + '/%'))
-    paths = [f"{result[Collection.name]}/{result[DataObject.name]}" for result in query]
-    paths = set(paths) # only unique paths
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(remove, path, avus) for path, avus in avus_per_path.items()]
+        for future in futures:
+            # re-raise any exception that happened in a worker
+            future.result()
+
+def tree_criteria(path):
+    """Criteria that select a collection and everything below it
+
+    An exact match on the collection itself is kept separate from the
+    'like' on its descendants, so the catalog can use its index on the
+    collection name for the first one.
+    """
+    return [
+        Criterion('=', Collection.name, path),
+        Criterion('like', Collection.name, path + '/%'),
+    ]
+
+def in_tree(name, path):
+    """Whether a collection is the given one or below it
+
+    '_' and '%' in the path are wildcards to 'like', so the query for
+    /zone/home/proj_1 also returns /zone/home/projX1. Rows are checked
+    with this before anything is removed.
+    """
+    return name == path or name.startswith(path + '/')
+
+def list_data_objects_with_metadata(session, path, prefixes=None, verbose=False):
+    """Fetch the AVUs of all data objects under a collection
+
+    Returns a dictionary mapping the path of each data object to its AVUs.
+    """
+    results = []
+    for criterion in tree_criteria(path):
+        query = session.query(
+            Collection.name,
+            DataObject.name,
+            DataObjectMeta.name,
+            DataObjectMeta.value,
+            DataObjectMeta.units,
+        )
+        query = query.filter(criterion, *prefix_criteria(DataObjectMeta, prefixes))
+        results.extend(query)
+    avus = {}
+    for result in results:
+        if not in_tree(result[Collection.name], path):
+            continue
+        obj_path = f"{result[Collection.name]}/{result[DataObject.name]}"
+        avus.setdefault(obj_path, []).append(
+            iRODSMeta(
+                result[DataObjectMeta.name],
+                result[DataObjectMeta.value],
+                result[DataObjectMeta.units],
+            )
+        )
     if verbose:
-        print(f"Found ({len(paths)} data objects with metadata")
-    return paths
-
-def list_subcollections_with_metadata(session, path, verbose=False):
-    query = session.query(CollectionMeta.name, Collection.name)
-    query.filter(Criterion('like', Collection.name, path + '/%'))
-    paths = [f"{result[Collection.name]}" for result in query]
-    paths = set(paths) # only unique paths
+        print(f"Found ({len(avus)} data objects with metadata")
+    return avus
+
+def list_subcollections_with_metadata(session, path, prefixes=None, verbose=False):
+    """Fetch the AVUs of a collection and all its subcollections
+
+    Returns a dictionary mapping the path of each collection to its AVUs.
+    """
+    results = []
+    for criterion in tree_criteria(path):
+        query = session.query(
+            Collection.name,
+            CollectionMeta.name,
+            CollectionMeta.value,
+            CollectionMeta.units,
+        )
+        query = query.filter(criterion, *prefix_criteria(CollectionMeta, prefixes))
+        results.extend(query)
+    avus = {}
+    for result in results:
+        if not in_tree(result[Collection.name], path):
+            continue
+        avus.setdefault(result[Collection.name], []).append(
+            iRODSMeta(
+                result[CollectionMeta.name],
+                result[CollectionMeta.value],
+                result[CollectionMeta.units],
+            )
+        )
     if verbose:
-        print(f"Found ({len(paths)} subcollections with metadata")
-    return paths
+        print(f"Found ({len(avus)} collections with metadata")
+    return avus
 
 
-def main(session, path, prefix = None, recursive=False, verbose=False):
+def main(session, path, prefixes = None, recursive=False, verbose=False):
     # if given path is a collection
     try:
         coll = session.collections.get(path)
-        remove_all_avus(coll, prefix, verbose)
-        if recursive:
-            data_objects = list_data_objects_with_metadata(session, path, verbose)
-            for data_object in data_objects:
-                obj = session.data_objects.get(data_object)
-                remove_all_avus(obj, prefix, verbose)
-            subcollections = list_subcollections_with_metadata(session, path, verbose)
-            for subcollection in subcollections:
-                obj = session.collections.get(subcollection)
-                remove_all_avus(obj, prefix, verbose)
+        if not recursive:
+            remove_all_avus(session, Collection, coll, prefixes, verbose)
+        else:
+            # AVUs are fetched in bulk, so no per-object metadata query is needed.
+            # The collection itself is part of the results.
+            data_objects = list_data_objects_with_metadata(session, path, prefixes, verbose)
+            remove_avus_concurrently(session, DataObject, data_objects, prefixes, verbose)
+            subcollections = list_subcollections_with_metadata(session, path, prefixes, verbose)
+            remove_avus_concurrently(session, Collection, subcollections, prefixes, verbose)
     except CollectionDoesNotExist:
         # if given path is a data object
         try:
@@ -63,7 +211,7 @@ def main(session, path, prefix = None, recursive=False, verbose=False):
                 raise Exception(
                     f"You cannot use a recursive operation on a data object."
                 )
-            remove_all_avus(obj, prefix, verbose)
+            remove_all_avus(session, DataObject, obj, prefixes, verbose)
         except DataObjectDoesNotExist:
             # if given path doesn't exist
             raise Exception(
@@ -93,18 +241,15 @@ if __name__ == "__main__":
         action="store_true",
         help="test",
     )
-    parser.add_argument('--prefix', dest='prefix', nargs='?', default=None)
+    parser.add_argument(
+        '--prefix',
+        dest='prefixes',
+        nargs='*',
+        default=None,
+        help="Only remove AVUs with an attribute name starting with one of these prefixes",
+    )
     args = parser.parse_args()
 
     # creating iRODS session
-    try:
-        env_file = os.environ["IRODS_ENVIRONMENT_FILE"]
-    except KeyError:
-        env_file = os.path.expanduser("~/.irods/irods_environment_prc.json")
-
-    ssl_context = ssl.create_default_context(
-        purpose=ssl.Purpose.SERVER_AUTH, cafile=None, capath=None, cadata=None
-    )
-    ssl_settings = {"ssl_context": ssl_context}
-    with iRODSSession(irods_env_file=env_file, **ssl_settings) as session:
-        main(session, args.path, args.prefix, args.recursive, args.verbose)
+    with make_session(PRC_ENV_FILE) as session:
+        main(session, args.path, args.prefixes, args.recursive, args.verbose)
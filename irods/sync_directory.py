@@ -1,71 +1,214 @@
 """Sync a directory to iRODS"""
 
 import os
-import ssl
-import binascii
 import base64
+import calendar
+import hashlib
 import json
+import logging
+import mmap
+import posixpath
+import sys
 import datetime
+import sqlite3
+import threading
 import time
-from hashlib import sha256
-from pathlib import Path
+import queue
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
 from irods.meta import AVUOperation, iRODSMeta
-from irods.session import iRODSSession
-from irods.exception import CollectionDoesNotExist, DataObjectDoesNotExist
+from irods.models import Collection, CollectionMeta, DataObject, DataObjectMeta
+from irods.column import Criterion
+from irods.exception import (
+    CollectionDoesNotExist,
+    DataObjectDoesNotExist,
+    NetworkException,
+    PycommandsException,
+    iRODSException,
+)
 from argparse import ArgumentParser
+from _session import make_session, warm_up_pool
+
+try:
+    import blake3
+except ImportError:
+    # only needed for --hash-algorithm blake3
+    blake3 = None
+
+# Messages about single files; shown with -v, failures are always shown
+logger = logging.getLogger(__name__)
+
+# Files of at least this size are uploaded with iRODS' parallel transfer,
+# by a separate pool of workers so they don't hold up the small files
+LARGE_FILE_THRESHOLD_BYTES = 256 << 20
+# Number of large files that are uploaded at the same time
+LARGE_FILE_WORKERS = 2
+# Number of streams used for the parallel transfer of a large file
+LARGE_FILE_THREADS = 4
+# Attribute of the AVU that holds the digest of a synced directory
+DIRECTORY_DIGEST_ATTRIBUTE = "sync_directory_digest"
+# Attribute of the AVU that holds the BLAKE3 digest of an uploaded file
+BLAKE3_ATTRIBUTE = "sync_directory_blake3"
+# Files of at least this size are memory-mapped for hashing; smaller ones are read
+MMAP_THRESHOLD_BYTES = 1 << 20
+# Size of the blocks in which a file is hashed while it's uploaded
+UPLOAD_BLOCK_SIZE = 4 << 20
+# Number of times an upload is tried when the network fails
+UPLOAD_ATTEMPTS = 5
+# Longest wait in seconds between two attempts; the wait doubles after every attempt
+MAX_RETRY_DELAY = 60
+# Number of jobs queued per worker before the walk waits for some to finish,
+# so memory stays bounded however many files there are
+JOBS_PER_WORKER = 4
+
+
+def list_data_objects_in_tree(session, root, blake3_digests=False):
+    """
+    Get the sizes and checksums of all data objects in a collection and the collections below it
 
+    The whole tree is fetched with two queries, instead of one per collection,
+    before anything is uploaded.
 
-def compare_filesize(session, file_path, data_object_path):
+    Arguments
+    ---------
+    session: obj
+        An iRODSSession object
+
+    root: str
+        The path of a collection in iRODS
+
+    blake3_digests: bool
+        Whether to also get the BLAKE3 digests stored as metadata,
+        which takes two more queries
+
+    Returns
+    -------
+
+    data_objects: dict
+        Dictionary mapping the paths of collections to dictionaries,
+        which map the names of their data objects to a tuple
+        of their size, checksum (None if no checksum was computed yet),
+        BLAKE3 digest (None if not stored, stale or not asked for)
+        and modify time in seconds since the epoch (None if not asked for)
     """
-    Compare the size of a local file and a file in iRODS
 
-    The function returns True in case both sizes match.
-    It returns False in case the sizes don't match,
-    or the data object doesn't exist
+    tree = (
+        Criterion("=", Collection.name, root),
+        Criterion("like", Collection.name, root + "/%"),
+    )
+    digests = {}
+    if blake3_digests:
+        for criterion in tree:
+            meta_query = session.query(
+                Collection.name,
+                DataObject.name,
+                DataObjectMeta.value,
+                DataObjectMeta.units,
+            ).filter(criterion, Criterion("=", DataObjectMeta.name, BLAKE3_ATTRIBUTE))
+            for result in meta_query:
+                key = (result[Collection.name], result[DataObject.name])
+                digests[key] = (
+                    result[DataObjectMeta.value],
+                    result[DataObjectMeta.units],
+                )
+
+    data_objects = {}
+    modify_times = {}
+    columns = [Collection.name, DataObject.name, DataObject.size, DataObject.checksum]
+    if blake3_digests:
+        columns.append(DataObject.modify_time)
+    for criterion in tree:
+        query = session.query(*columns).filter(criterion)
+        for result in query:
+            key = (result[Collection.name], result[DataObject.name])
+            if blake3_digests:
+                # one row per replica; the digest is tied to the latest one
+                modify_time = to_epoch(result[DataObject.modify_time])
+                modify_times[key] = max(modify_times.get(key, 0), modify_time)
+            data_objects.setdefault(key[0], {})[key[1]] = (
+                result[DataObject.size],
+                result[DataObject.checksum],
+                None,
+                modify_times.get(key),
+            )
+
+    for key, (digest, modify_time) in digests.items():
+        objects = data_objects.get(key[0], {})
+        # a digest stored before the data object was last written is stale
+        if key[1] in objects and modify_time == str(modify_times[key]):
+            size, checksum, _, modify_time = objects[key[1]]
+            objects[key[1]] = (size, checksum, digest, modify_time)
+    return data_objects
+
+
+def list_collections(session, root):
+    """
+    Get the paths of a collection and all collections below it
 
     Arguments
     ---------
     session: obj
         An iRODSSession object
 
-    local_path: str
-        The path of a local file
-        Please provide a full path
+    root: str
+        The path of a collection in iRODS
 
-    destination: str
-        The path to a data object in iRODS
-        Please provide a full path.
+    Returns
+    -------
+
+    collections: set
+        The paths of the existing collections
+    """
+
+    collections = set()
+    for criterion in (
+        Criterion("=", Collection.name, root),
+        Criterion("like", Collection.name, root + "/%"),
+    ):
+        query = session.query(Collection.name).filter(criterion)
+        collections.update(result[Collection.name] for result in query)
+    return collections
+
+
+def list_directory_digests(session, root):
+    """
+    Get the directory digests stored on a collection and all collections below it
+
+    Arguments
+    ---------
+    session: obj
+        An iRODSSession object
+
+    root: str
+        The path of a collection in iRODS
 
     Returns
     -------
 
-    do_sizes_match: bool
-        True if sizes match, False in case of a mismatch.
+    digests: dict
+        Dictionary mapping the paths of the collections to their digest
     """
 
-    try:
-        size_irods = session.data_objects.get(data_object_path).size
-        size_local = file_path.stat().st_size
-        if size_irods == size_local:
-            do_sizes_match = True
-        else:
-            do_sizes_match = False
-    except (DataObjectDoesNotExist, CollectionDoesNotExist):
-        # Function will fail if data object doesn't exist
-        do_sizes_match = False
-    return do_sizes_match
+    digests = {}
+    for criterion in (
+        Criterion("=", Collection.name, root),
+        Criterion("like", Collection.name, root + "/%"),
+    ):
+        query = session.query(Collection.name, CollectionMeta.value).filter(
+            criterion, Criterion("=", CollectionMeta.name, DIRECTORY_DIGEST_ATTRIBUTE)
+        )
+        digests.update(
+            (result[Collection.name], result[CollectionMeta.value]) for result in query
+        )
+    return digests
 
 
 def irods_to_sha256_checksum(irods_checksum):
     """Transforms a checksum from iRODS to the standard sha256 checksum"""
 
-    if irods_checksum is None or not irods_checksum.startswith("sha2:"):
+    if not irods_checksum or not irods_checksum.startswith("sha2:"):
         return None
 
-    sha256_checksum = binascii.hexlify(base64.b64decode(irods_checksum[5:]))
-    sha256_checksum = sha256_checksum.decode("utf-8")
-
-    return sha256_checksum
+    return base64.b64decode(irods_checksum[5:]).hex()
 
 
 def create_modify_time_avu(path):
@@ -130,13 +273,248 @@ def add_metadata(session, file, data_object, metadata_methods):
     avus = [
         iRODSMeta(item["attribute"], item["value"], item["units"]) for item in avu_dicts
     ]
-    obj = session.data_objects.get(data_object)
-    obj.metadata.apply_atomic_operations(
-        *[AVUOperation(operation="add", avu=item) for item in avus]
+    # addressed by path, so the data object doesn't have to be fetched first
+    operations = [AVUOperation(operation="add", avu=item) for item in avus]
+    session.metadata.apply_atomic_operations(DataObject, data_object, *operations)
+
+
+def new_sha256():
+    """
+    Create a sha256 hash object
+
+    hashlib.new uses the OpenSSL implementation, which uses the SHA extensions
+    of the CPU (SHA-NI on x86, SHA2 on ARMv8) when available.
+    The checksum only verifies transfers, so it isn't used for security.
+    """
+
+    return hashlib.new("sha256", usedforsecurity=False)
+
+
+def directory_digest(files):
+    """
+    Compute a digest of the files in a directory
+
+    The digest covers the name, size and modify time of every file,
+    so it changes whenever a file is added, removed or modified.
+
+    Arguments
+    ---------
+    files: list
+        os.DirEntry objects for the files in the directory
+
+    Returns
+    -------
+    digest: str
+        Hexadecimal sha256 digest
+    """
+
+    digest = new_sha256()
+    for file in sorted(files, key=lambda file: file.name):
+        stat = file.stat()
+        digest.update(f"{file.name}\0{stat.st_size}\0{stat.st_mtime_ns}\n".encode())
+    return digest.hexdigest()
+
+
+class ChecksumCache:
+    """
+    Cache of sha256 checksums of local files, stored in an SQLite database
+
+    A cached checksum is only used as long as the size and modify time
+    of the file are the same as when the checksum was computed.
+    The cache can be shared by multiple threads.
+
+    Arguments
+    ---------
+    filename: str
+        The path of the database file. It is created if it doesn't exist.
+    """
+
+    def __init__(self, filename):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+        with self.lock, self.connection:
+            # with write-ahead logging, a commit doesn't wait for the disk
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS checksums "
+                "(path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, sha256 TEXT)"
+            )
+
+    def get(self, path, size, mtime_ns):
+        """Return the cached checksum, or None if the file is unknown or changed"""
+
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT sha256 FROM checksums WHERE path=? AND size=? AND mtime_ns=?",
+                (path, size, mtime_ns),
+            ).fetchone()
+        return row[0] if row else None
+
+    def set(self, path, size, mtime_ns, sha256):
+        """Store the checksum of a file"""
+
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO checksums VALUES (?, ?, ?, ?)",
+                (path, size, mtime_ns, sha256),
+            )
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+def compute_sha256(
+    file_path, checksum_cache=None, drop_cache=False, blake3_hasher=None
+):
+    """
+    Compute the sha256 checksum of a local file
+
+    Arguments
+    ---------
+    file_path: str
+        The path of a local file
+
+    checksum_cache: ChecksumCache
+        Optional cache to look the checksum up in before hashing the file,
+        and to store newly computed checksums in.
+
+    drop_cache: bool
+        Whether to tell the kernel the file's pages can be dropped from the page cache
+        after hashing. Use it when the file won't be read again,
+        so hashing large files doesn't evict more useful pages.
+
+    blake3_hasher: obj
+        Optional blake3 hasher that is fed the file in the same pass,
+        so both hashes cost a single read. The file is always read then,
+        even if its checksum is cached.
+
+    Returns
+    -------
+    checksum: str
+        The hexadecimal sha256 checksum
+    """
+
+    if checksum_cache is not None:
+        path = os.path.abspath(file_path)
+        stat = os.stat(file_path)
+        checksum = checksum_cache.get(path, stat.st_size, stat.st_mtime_ns)
+        if checksum is not None and blake3_hasher is None:
+            return checksum
+
+    with open(file_path, "rb") as file:
+        size = os.fstat(file.fileno()).st_size
+        if hasattr(os, "posix_fadvise"):
+            # let the kernel read ahead
+            os.posix_fadvise(file.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        if size >= MMAP_THRESHOLD_BYTES and sys.maxsize > 2**32:
+            # hash the pages straight from the page cache, without copying them
+            # into Python buffers first. For small files, setting up the mapping
+            # costs more than the copy it saves.
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                if hasattr(mapped, "madvise"):
+                    mapped.madvise(mmap.MADV_SEQUENTIAL)
+                hash_sha256 = new_sha256()
+                hash_sha256.update(mapped)
+                if blake3_hasher is not None:
+                    blake3_hasher.update(mapped)
+        elif hasattr(hashlib, "file_digest") and blake3_hasher is None:
+            # Python 3.11+ reads and hashes the file without a Python-level loop
+            hash_sha256 = hashlib.file_digest(file, new_sha256)
+        else:
+            hash_sha256 = new_sha256()
+            for chunk in iter(lambda: file.read(1 << 20), b""):
+                hash_sha256.update(chunk)
+                if blake3_hasher is not None:
+                    blake3_hasher.update(chunk)
+        if drop_cache and hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(file.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+    checksum = hash_sha256.hexdigest()
+
+    if checksum_cache is not None:
+        checksum_cache.set(path, stat.st_size, stat.st_mtime_ns, checksum)
+    return checksum
+
+
+def compute_blake3(file_path):
+    """
+    Compute the BLAKE3 digest of a local file
+
+    The file is memory-mapped and hashed by multiple threads,
+    which is much faster than sha256 for large files.
+    Requires the blake3 package.
+
+    Arguments
+    ---------
+    file_path: str
+        The path of a local file
+
+    Returns
+    -------
+    digest: str
+        The hexadecimal BLAKE3 digest
+    """
+
+    hasher = blake3.blake3(max_threads=blake3.blake3.AUTO)
+    with open(file_path, "rb") as f:
+        # empty files can't be memory-mapped
+        if os.fstat(f.fileno()).st_size > 0:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                hasher.update(mapped)
+    return hasher.hexdigest()
+
+
+def to_epoch(modify_time):
+    """Convert a modify time from an iRODS query (naive UTC) to seconds since the epoch"""
+
+    return calendar.timegm(modify_time.utctimetuple())
+
+
+def get_modify_time(session, data_object_path):
+    """Get the time a data object was last written, in seconds since the epoch"""
+
+    collection, name = posixpath.split(data_object_path)
+    query = session.query(DataObject.modify_time).filter(
+        Criterion("=", Collection.name, collection),
+        Criterion("=", DataObject.name, name),
     )
+    return max(to_epoch(result[DataObject.modify_time]) for result in query)
+
+
+def store_blake3(session, data_object_path, digest, modify_time=None):
+    """
+    Store the BLAKE3 digest of a local file as metadata on its data object
+
+    iRODS itself can only compute sha256 (or md5) checksums,
+    so the digest is kept in an AVU to compare against on the next sync.
+    The units of the AVU hold the modify time of the data object,
+    so the digest is ignored once the data object is overwritten
+    by anything else, like a sync by size or another client.
+    It's looked up unless it's given, in seconds since the epoch.
+
+    Storing the digest only speeds up the next sync, so a failure,
+    like a data object the user may read but not change, is logged
+    and otherwise ignored.
+    """
+
+    try:
+        if modify_time is None:
+            modify_time = get_modify_time(session, data_object_path)
+        session.metadata.set(
+            DataObject,
+            data_object_path,
+            iRODSMeta(BLAKE3_ATTRIBUTE, digest, str(modify_time)),
+        )
+    except (PycommandsException, iRODSException) as e:
+        logger.warning(
+            "Storing the BLAKE3 digest of %s failed: %r", data_object_path, e
+        )
 
 
-def compare_checksums(session, file_path, data_object_path):
+def compare_checksums(
+    session, file_path, data_object_path, checksum_cache=None, local_checksum=None
+):
     """Check whether the checksum of a local file matches its iRODS equivalent
 
 
@@ -153,6 +531,12 @@ def compare_checksums(session, file_path, data_object_path):
         The path to a data object in iRODS
         Please provide a full path.
 
+    checksum_cache: ChecksumCache
+        Optional cache of local checksums
+
+    local_checksum: str
+        The sha256 checksum of the local file, if it was computed already
+
     Returns
     -------
 
@@ -163,7 +547,7 @@ def compare_checksums(session, file_path, data_object_path):
     try:
         # get data object first so function fails early if data object does not exist
         obj = session.data_objects.get(data_object_path)
-        if not obj.size == file_path.stat().st_size:
+        if not obj.size == os.path.getsize(file_path):
             # checksums cannot match if file sizes differ
             return False
         try:
@@ -173,16 +557,15 @@ def compare_checksums(session, file_path, data_object_path):
             if e.args == (-1803000,):
                 # The object is locked, so a checksum cannot be made.
                 return False
+            raise
         irods_checksum_sha256 = irods_to_sha256_checksum(irods_checksum)
 
-        # get local checksum
-        hash_sha256 = sha256()
-        with open(file_path, "rb") as file:
-            for chunk in iter(lambda: file.read(32768), b""):
-                hash_sha256.update(chunk)
-        local_checksum_sha256 = hash_sha256.hexdigest()
+        # get local checksum, unless the caller hashed the file already.
+        # This is the last time the file is read, so it can leave the page cache.
+        if local_checksum is None:
+            local_checksum = compute_sha256(file_path, checksum_cache, drop_cache=True)
 
-        do_checksums_match = local_checksum_sha256 == irods_checksum_sha256
+        do_checksums_match = local_checksum == irods_checksum_sha256
     except (CollectionDoesNotExist, DataObjectDoesNotExist):
         # Function will fail if data object doesn't exist
         do_checksums_match = False
@@ -190,7 +573,70 @@ def compare_checksums(session, file_path, data_object_path):
     return do_checksums_match
 
 
-def upload_file(session, source, destination, post_check=False):
+def put_and_hash(session, source, destination, checksum_cache=None, blake3_hasher=None):
+    """
+    Upload a file to iRODS while computing its sha256 checksum
+
+    The file is read once: every block is hashed and then written to the data object,
+    so a post check doesn't need to read the file again.
+
+    Arguments
+    ---------
+    session: obj
+        An iRODSSession object
+
+    source: str
+        The path of a local file
+
+    destination: str
+        The path to a data object in iRODS
+
+    checksum_cache: ChecksumCache
+        Optional cache to store the checksum in,
+        so the next sync doesn't need to hash the file again
+
+    blake3_hasher: obj
+        Optional blake3 hasher that is fed the uploaded bytes as well.
+        It's reset first, so it only holds the bytes of this upload.
+
+    Returns
+    -------
+    checksum: str
+        The hexadecimal sha256 checksum of the uploaded bytes
+    """
+
+    hash_sha256 = new_sha256()
+    if blake3_hasher is not None:
+        blake3_hasher.reset()
+    buffer = bytearray(UPLOAD_BLOCK_SIZE)
+    view = memoryview(buffer)
+    with open(source, "rb") as file, session.data_objects.open(destination, "w") as obj:
+        # taken before reading, so a file changed meanwhile isn't cached as unchanged
+        stat = os.fstat(file.fileno())
+        while size := file.readinto(buffer):
+            hash_sha256.update(view[:size])
+            if blake3_hasher is not None:
+                blake3_hasher.update(view[:size])
+            obj.write(view[:size])
+    checksum = hash_sha256.hexdigest()
+
+    if checksum_cache is not None:
+        checksum_cache.set(
+            os.path.abspath(source), stat.st_size, stat.st_mtime_ns, checksum
+        )
+    return checksum
+
+
+def upload_file(
+    session,
+    source,
+    destination,
+    post_check=False,
+    checksum_cache=None,
+    num_threads=1,
+    local_checksum=None,
+    blake3_hasher=None,
+):
     """Upload a file to iRODS
 
     Arguments
@@ -210,27 +656,284 @@ def upload_file(session, source, destination, post_check=False):
     post_check: bool
         Whether to checksum files after upload
 
+    checksum_cache: ChecksumCache
+        Optional cache of local checksums, used by the post check
+        and filled with the checksums computed while sending files
+
+    num_threads: int
+        Number of streams used for the transfer.
+        With 1 the file is sent over a single connection.
+
+    local_checksum: str
+        The sha256 checksum of the local file, if it was computed already.
+        The post check uses it instead of hashing the file again.
+        Without it, a single-stream upload with post check hashes the file
+        while sending it (see put_and_hash).
+
+    blake3_hasher: obj
+        Optional blake3 hasher to feed the file to while sending it.
+        Only used by single-stream uploads.
+
     Returns
     -------
     success: bool
         True if file was successfully uploaded, otherwise false
     """
 
-    print(f"Uploading {source}.")
+    logger.debug("Uploading %s.", source)
+    hash_while_uploading = num_threads == 1 and (
+        blake3_hasher is not None or (post_check and local_checksum is None)
+    )
     try:
-        session.data_objects.put(source, destination)
+        for attempt in range(1, UPLOAD_ATTEMPTS + 1):
+            try:
+                if hash_while_uploading:
+                    local_checksum = put_and_hash(
+                        session, source, destination, checksum_cache, blake3_hasher
+                    )
+                else:
+                    session.data_objects.put(
+                        source, destination, num_threads=num_threads
+                    )
+                break
+            except NetworkException as e:
+                if attempt == UPLOAD_ATTEMPTS:
+                    raise
+                delay = min(2 ** (attempt - 1), MAX_RETRY_DELAY)
+                logger.warning(
+                    "Uploading %s failed (%s), retrying in %s s", source, e, delay
+                )
+                time.sleep(delay)
         if post_check:
-            print("Verifying file after transfer")
-            success = compare_checksums(session, source, destination)
+            logger.debug("Verifying %s after transfer", source)
+            success = compare_checksums(
+                session, source, destination, checksum_cache, local_checksum
+            )
         else:
             success = True
 
-    except:
-        print(f"Uploading {source} failed")
+    except (PycommandsException, iRODSException, OSError, RuntimeError) as e:
+        # the parallel transfer raises RuntimeError when one of its streams fails;
+        # any other exception is a bug, and stops the sync when its result is read
+        logger.error("Uploading %s failed: %r", source, e)
         success = False
     return success
 
 
+def list_directory_contents(source, max_workers=4):
+    """
+    Walk through a local directory and all its subdirectories
+
+    Directories are listed concurrently by a pool of threads, which helps
+    on network and parallel file systems where listing is slow.
+    Every directory is listed once with os.scandir; the DirEntry objects
+    cache the file type and the result of stat().
+    Directories are yielded as soon as they are listed, so a subdirectory
+    can come before its parent.
+
+    Arguments
+    ---------
+    source: str
+        The path of a local directory
+
+    max_workers: int
+        Number of directories that are listed concurrently
+
+    Yields
+    ------
+    relative_path: str
+        The path of the directory relative to the parent of source,
+        so it starts with the name of source
+    files: list
+        os.DirEntry objects for the files in the directory
+    """
+
+    # bounded, so listing doesn't run too far ahead of the uploads
+    listed = queue.Queue(maxsize=10000)
+    done = object()
+    stop = threading.Event()
+    pending = 1
+    lock = threading.Lock()
+
+    def scan(directory, relative_path):
+        nonlocal pending
+        try:
+            if stop.is_set():
+                return
+            with os.scandir(directory) as it:
+                entries = list(it)
+            files = [e for e in entries if e.is_file()]
+            for subdir in entries:
+                if subdir.is_dir():
+                    with lock:
+                        pending += 1
+                    executor.submit(scan, subdir.path, f"{relative_path}/{subdir.name}")
+            listed.put((relative_path, files))
+        except Exception as e:
+            listed.put(e)
+        finally:
+            with lock:
+                pending -= 1
+                if pending == 0:
+                    listed.put(done)
+
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        executor.submit(scan, source, os.path.basename(os.path.normpath(source)))
+        while (item := listed.get()) is not done:
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        # make room for threads that are waiting to put a result in the queue
+        while not listed.empty():
+            listed.get_nowait()
+        executor.shutdown(cancel_futures=True)
+
+
+def process_file(
+    session,
+    file_path,
+    data_object_path,
+    local_size,
+    remote,
+    verification_method="size",
+    post_check=False,
+    checksum_cache=None,
+    num_threads=1,
+    hash_algorithm="sha256",
+    metadata_methods=(),
+):
+    """
+    Verify a local file against its data object and upload it when they differ
+
+    Arguments
+    ---------
+
+    session: obj
+        An iRODSSession object
+
+    file_path: str
+        The path of a local file
+
+    data_object_path: str
+        The path to a data object in iRODS
+
+    local_size: int
+        The size of the local file
+
+    remote: tuple
+        The size, checksum, BLAKE3 digest and modify time of the data object
+        as found by list_data_objects_in_tree, or None if it doesn't exist
+
+    verification_method: str
+        Method of verifying whether a file in iRODS should be updated
+        (size/checksum)
+
+    post_check: bool
+        Whether to checksum files after upload
+
+    checksum_cache: ChecksumCache
+        Optional cache of local checksums
+
+    num_threads: int
+        Number of streams used to upload the file
+
+    hash_algorithm: str
+        Hash used by the checksum verification (sha256/blake3).
+        With blake3, the file is compared against the digest stored as metadata
+        at its last upload. Data objects without one are compared with sha256,
+        after which the digest is stored.
+
+    metadata_methods: list
+        Functions to extract metadata from the file, which is added
+        to the data object after a successful upload (see add_metadata)
+
+    Returns
+    -------
+
+    status: str
+        'skipped' if the data object was already up to date,
+        otherwise 'succeeded' or 'failed' depending on the upload
+    """
+
+    # size and checksum of existing data objects were fetched in bulk
+    local_checksum = None
+    local_blake3 = None
+    blake3_hasher = None
+    if verification_method == "checksum" and hash_algorithm == "blake3":
+        # fed by whichever pass reads the file first, so it's read only once
+        blake3_hasher = blake3.blake3(max_threads=blake3.blake3.AUTO)
+    if remote is None:
+        files_match = False
+    elif verification_method == "size":
+        files_match = remote[0] == local_size
+    elif verification_method == "checksum":
+        remote_size, remote_checksum, remote_blake3, remote_modify_time = remote
+        if remote_size != local_size:
+            # checksums cannot match if file sizes differ
+            files_match = False
+        elif hash_algorithm == "blake3" and remote_blake3 is not None:
+            local_blake3 = compute_blake3(file_path)
+            files_match = local_blake3 == remote_blake3
+        else:
+            # hashed once, and reused by the post check if the file is uploaded
+            local_checksum = compute_sha256(
+                file_path, checksum_cache, blake3_hasher=blake3_hasher
+            )
+            if blake3_hasher is not None:
+                local_blake3 = blake3_hasher.hexdigest()
+            if remote_checksum is None:
+                # let iRODS compute the checksum
+                files_match = compare_checksums(
+                    session, file_path, data_object_path, local_checksum=local_checksum
+                )
+                # registering the checksum may have changed the modify time
+                remote_modify_time = None
+            else:
+                files_match = local_checksum == irods_to_sha256_checksum(
+                    remote_checksum
+                )
+            if files_match and local_blake3 is not None:
+                # so the next sync can use the faster hash
+                store_blake3(
+                    session, data_object_path, local_blake3, remote_modify_time
+                )
+
+    if files_match:
+        return "skipped"
+    if blake3_hasher is not None and local_blake3 is None and num_threads > 1:
+        # the parallel transfer reads the file itself, so hash it beforehand,
+        # together with the checksum for the post check
+        if post_check:
+            local_checksum = compute_sha256(
+                file_path, checksum_cache, blake3_hasher=blake3_hasher
+            )
+            local_blake3 = blake3_hasher.hexdigest()
+        else:
+            local_blake3 = compute_blake3(file_path)
+    if upload_file(
+        session,
+        file_path,
+        data_object_path,
+        post_check,
+        checksum_cache,
+        num_threads,
+        local_checksum,
+        blake3_hasher if local_blake3 is None else None,
+    ):
+        if blake3_hasher is not None:
+            if local_blake3 is None:
+                local_blake3 = blake3_hasher.hexdigest()
+            store_blake3(session, data_object_path, local_blake3)
+        # add metadata, if any methods were provided to do so
+        if metadata_methods:
+            add_metadata(session, file_path, data_object_path, metadata_methods)
+        return "succeeded"
+    return "failed"
+
+
 def sync_directory(
     session,
     source,
@@ -238,6 +941,13 @@ def sync_directory(
     verification_method="size",
     post_check=False,
     metadata_methods=[],
+    max_workers=8,
+    state=None,
+    checksum_cache=None,
+    large_file_threshold=LARGE_FILE_THRESHOLD_BYTES,
+    directory_digests=False,
+    hash_algorithm="sha256",
+    log=None,
 ):
     """
     Synchronize a directory to iRODS
@@ -270,103 +980,273 @@ def sync_directory(
         Any functions that need to be executed to extract metadata
         from the file or its context to be added as metadata.
 
+    max_workers: int
+        Number of small files that are verified and uploaded concurrently.
+        The threads share the session, which gives each of them
+        its own connection from its pool.
+
+    state: dict
+        The size and modify time of the local files at their last successful sync,
+        keyed by data object path (see load_sync_state).
+        Files that haven't changed since are skipped without contacting iRODS.
+        The dictionary is updated in place.
+
+    checksum_cache: ChecksumCache
+        Optional cache of local checksums, so unchanged files
+        don't need to be hashed again on the next sync.
+
+    large_file_threshold: int
+        Files of at least this many bytes are uploaded by a separate pool of
+        LARGE_FILE_WORKERS threads, each using LARGE_FILE_THREADS streams.
+        Small files are sent over a single stream each.
+
+    directory_digests: bool
+        Whether to keep a digest of every directory as metadata on its collection.
+        The digest is updated when all files in the directory were synced successfully.
+        Directories whose digest hasn't changed since are skipped without
+        checking their files in iRODS.
+
+    hash_algorithm: str
+        Hash used to compare files when verifying by checksum (sha256/blake3).
+        BLAKE3 digests are kept as metadata on the data objects,
+        since iRODS can't compute them. The post check always uses sha256.
+
+    log: file
+        Optional text file to write the result of every file to as soon as it's known,
+        as one JSON object per line (see open_log).
+        The lists of files aren't kept in memory.
+
     Returns
     -------
 
     results: dict
-        A dictionary that contains lists of the files that were skipped, succeeded and failed,
+        A dictionary that contains the number of files that were skipped, succeeded and failed,
         as well as the total filesize uploaded.
     """
 
-    succeeded = []
-    skipped = []
-    failed = []
-    cumulative_filesize_in_bytes = 0
-
-    # Create a collection for the current directory
-    directory = Path(source)
-    collection = f"{destination}/{directory.name}"
-    try:
-        session.collections.get(collection)
-    except CollectionDoesNotExist:
-        print(f"Creating collection {collection}")
-        session.collections.create(collection)
-
-    # upload all files in the directory
-    files = [f for f in directory.iterdir() if f.is_file()]
-    for file in files:
-        data_object = f"{collection}/{file.name}"
-
-        # verification of file, if it exists
-        if verification_method == "size":
-            files_match = compare_filesize(session, file, data_object)
-        elif verification_method == "checksum":
-            files_match = compare_checksums(session, file, data_object)
-
-        if not files_match:
-            success = upload_file(session, file, data_object, post_check)
-            if success:
-                # log success
-                succeeded.append(data_object)
-                size = session.data_objects.get(data_object).size
-                cumulative_filesize_in_bytes += size
-
-                # add metadata, if any methods were provided to do so
-                if len(metadata_methods) > 0:
-                    add_metadata(session, file, data_object, metadata_methods)
-            else:
-                # log failure
-                failed.append(str(file))
-        else:
-            # log skipped file
-            print(f"{data_object} was already uploaded with good status.")
-            skipped.append(data_object)
-
     results = {
-        "succeeded": succeeded,
-        "skipped": skipped,
-        "failed": failed,
-        "cumulative_filesize_in_bytes": cumulative_filesize_in_bytes,
+        "succeeded": 0,
+        "skipped": 0,
+        "failed": 0,
+        "cumulative_filesize_in_bytes": 0,
     }
 
-    # for all subdirectories, run this function again
-    subdirs = [d for d in directory.iterdir() if d.is_dir()]
-    for subdir in subdirs:
-        subdir_result = sync_directory(
+    def record(status, path, local_state=None):
+        results[status] += 1
+        if log is not None:
+            entry = {"path": path, "status": status}
+            if local_state is not None:
+                entry["size"], entry["mtime_ns"] = local_state
+            log.write(json.dumps(entry) + "\n")
+
+    # the collections that exist already are queried once for the whole tree
+    # a trailing slash on source is ignored, as Path.name did
+    root_collection = f"{destination}/{os.path.basename(os.path.normpath(source))}"
+    existing_collections = list_collections(session, root_collection)
+    # and so are the data objects in them, so they can be compared without a round trip
+    remote_data_objects = (
+        list_data_objects_in_tree(
             session,
-            subdir,
-            collection,
-            verification_method,
-            post_check,
-            metadata_methods,
+            root_collection,
+            verification_method == "checksum" and hash_algorithm == "blake3",
         )
-        results["succeeded"].extend(subdir_result["succeeded"])
-        results["skipped"].extend(subdir_result["skipped"])
-        results["failed"].extend(subdir_result["failed"])
-        results["cumulative_filesize_in_bytes"] += subdir_result[
-            "cumulative_filesize_in_bytes"
-        ]
+        if existing_collections
+        else {}
+    )
+    digests = (
+        list_directory_digests(session, root_collection) if directory_digests else None
+    )
+    # collection path -> [files still being processed, digest, all files synced]
+    pending_directories = {}
+
+    def finish_directory(collection):
+        remaining, digest, complete = pending_directories.pop(collection)
+        if complete and digests.get(collection) != digest:
+            session.metadata.set(
+                Collection, collection, iRODSMeta(DIRECTORY_DIGEST_ATTRIBUTE, digest)
+            )
+
+    def log_result(job, file, data_object, local_state, collection):
+        status = job.result()
+        if status == "skipped":
+            # log skipped file
+            logger.debug("%s was already uploaded with good status.", data_object)
+            record("skipped", data_object, local_state)
+        elif status == "succeeded":
+            # log success; the local size was already known, no need to ask iRODS
+            record("succeeded", data_object, local_state)
+            results["cumulative_filesize_in_bytes"] += local_state[0]
+        else:
+            # log failure
+            record("failed", file)
+        if state is not None and status != "failed":
+            state[data_object] = local_state
+        if digests is not None:
+            directory = pending_directories[collection]
+            directory[0] -= 1
+            directory[2] = directory[2] and status != "failed"
+            if directory[0] == 0:
+                finish_directory(collection)
+
+    # Directories are listed by one pool of threads (the producer),
+    # while the files in them are verified and uploaded by others (the consumers).
+    # Large files get their own pool, so they don't block the small ones.
+    small_files = ThreadPoolExecutor(max_workers=max_workers)
+    large_files = ThreadPoolExecutor(max_workers=LARGE_FILE_WORKERS)
+    max_jobs = JOBS_PER_WORKER * (max_workers + LARGE_FILE_WORKERS)
+    jobs = {}
+    try:
+        for relative_path, files in list_directory_contents(source):
+            # Create a collection for the current directory.
+            # Parent collections are created along with it if needed.
+            collection = f"{destination}/{relative_path}"
+            # the data objects in it only need the name of the file appended
+            prefix = collection + "/"
+            if digests is not None:
+                digest = directory_digest(files)
+                if digests.get(collection) == digest:
+                    # nothing changed since the directory was last synced completely
+                    for file in files:
+                        data_object = prefix + file.name
+                        logger.debug(
+                            "%s was already uploaded with good status.", data_object
+                        )
+                        stat = file.stat()
+                        record("skipped", data_object, [stat.st_size, stat.st_mtime_ns])
+                    continue
+
+            if collection in existing_collections:
+                data_objects = remote_data_objects.get(collection, {})
+            else:
+                logger.debug("Creating collection %s", collection)
+                session.collections.create(collection)
+                data_objects = {}
+
+            if digests is not None:
+                # held at one until all files of the directory were submitted,
+                # so it isn't finished by the jobs that complete in the meantime
+                pending_directories[collection] = [1, digest, True]
+            for file in files:
+                data_object = prefix + file.name
+                stat = file.stat()
+                local_state = [stat.st_size, stat.st_mtime_ns]
+
+                if state is not None and state.get(data_object) == local_state:
+                    # unchanged since the last successful sync
+                    logger.debug(
+                        "%s was already uploaded with good status.", data_object
+                    )
+                    record("skipped", data_object, local_state)
+                    continue
+
+                if stat.st_size < large_file_threshold:
+                    executor, num_threads = small_files, 1
+                else:
+                    executor, num_threads = large_files, LARGE_FILE_THREADS
+                job = executor.submit(
+                    process_file,
+                    session,
+                    file.path,
+                    data_object,
+                    stat.st_size,
+                    data_objects.get(file.name),
+                    verification_method,
+                    post_check,
+                    checksum_cache,
+                    num_threads,
+                    hash_algorithm,
+                    metadata_methods,
+                )
+                jobs[job] = (file.path, data_object, local_state, collection)
+                if digests is not None:
+                    pending_directories[collection][0] += 1
+
+                if len(jobs) >= max_jobs:
+                    # wait for a worker to catch up before queueing more
+                    finished, _ = wait(jobs, return_when=FIRST_COMPLETED)
+                    for finished_job in finished:
+                        log_result(finished_job, *jobs.pop(finished_job))
+
+            if digests is not None:
+                directory = pending_directories[collection]
+                directory[0] -= 1
+                if directory[0] == 0:
+                    finish_directory(collection)
+
+        for job in as_completed(jobs):
+            log_result(job, *jobs[job])
+    except BaseException:
+        # don't wait for the queued files on Ctrl-C or an error
+        small_files.shutdown(wait=False, cancel_futures=True)
+        large_files.shutdown(wait=False, cancel_futures=True)
+        raise
+    finally:
+        small_files.shutdown()
+        large_files.shutdown()
 
     return results
 
 
-def write_results_to_log(results):
-    """Write results to a JSON file"""
+def load_sync_state(filename):
+    """
+    Read the state of a previous sync from a JSON file
+
+    Returns an empty state if the file doesn't exist yet.
+    """
+
+    try:
+        with open(filename) as file:
+            state = json.load(file)
+    except FileNotFoundError:
+        state = {}
+    return state
+
+
+def load_log_state(filename):
+    """
+    Read the files that were synced successfully from the log of a previous sync
+
+    The log is read line by line, so it doesn't need to fit in memory twice.
+    A partly written last line, left by a sync that was killed, is ignored.
+    Returns a state in the same format as load_sync_state.
+    """
+
+    state = {}
+    with open(filename) as file:
+        for line in file:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                break
+            if entry.get("status") in ("succeeded", "skipped") and "mtime_ns" in entry:
+                state[entry["path"]] = [entry["size"], entry["mtime_ns"]]
+    return state
+
+
+def write_sync_state(state, filename):
+    """Write the state of the sync to a JSON file"""
+
+    with open(filename, "w") as file:
+        json.dump(state, file)
+
+
+def open_log():
+    """Open a JSON lines file to log results in, named after the current time"""
 
     date = datetime.datetime.now()
     formatted_date = date.strftime("%Y%m%d%H%M%S")
-    filename = f"sync_log_{formatted_date}.json"
+    filename = f"sync_log_{formatted_date}.jsonl"
 
-    with open(filename, "w") as file:
-        json.dump(results, file)
+    # line buffered, so every result is on disk even if the sync gets killed
+    return open(filename, "w", buffering=1)
 
 
 def summarize(source, destination, results):
     """Print summary of results"""
 
-    number_skipped = len(results["skipped"])
-    number_succeeded = len(results["succeeded"])
-    number_failed = len(results["failed"])
+    number_skipped = results["skipped"]
+    number_succeeded = results["succeeded"]
+    number_failed = results["failed"]
     cumulative_filesize_in_bytes = results["cumulative_filesize_in_bytes"]
 
     print(f"{source} was synchronized to {destination}")
@@ -403,37 +1283,116 @@ if __name__ == "__main__":
         action="store_true",
         help="Add the last modified time of the local file as metadata to the dataobject after uploading",
     )
+    parser.add_argument(
+        "--state-file",
+        dest="state_file",
+        default=None,
+        help="JSON file to keep the size and modify time of synced files in. "
+        "Files that haven't changed since the last sync are skipped without contacting iRODS",
+    )
+    parser.add_argument(
+        "--resume-log",
+        dest="resume_log",
+        default=None,
+        help="Log of an interrupted sync. Files it lists as synced are skipped "
+        "without contacting iRODS, unless their size or modify time changed",
+    )
+    parser.add_argument(
+        "--concurrency",
+        dest="concurrency",
+        type=int,
+        default=8,
+        help="The number of small files that are verified and uploaded at the same time",
+    )
+    parser.add_argument(
+        "--large-file-threshold",
+        dest="large_file_threshold",
+        type=int,
+        default=LARGE_FILE_THRESHOLD_BYTES,
+        help="Files of at least this many bytes are uploaded separately, "
+        "using multiple streams per file",
+    )
+    parser.add_argument(
+        "--directory-digests",
+        dest="directory_digests",
+        action="store_true",
+        help="Keep a digest of every synced directory as metadata on its collection. "
+        "Directories that haven't changed since are skipped",
+    )
+    parser.add_argument(
+        "--hash-algorithm",
+        dest="hash_algorithm",
+        choices=["sha256", "blake3"],
+        default="sha256",
+        help="The hash used to compare files when verifying by checksum. "
+        "blake3 is faster, but needs the blake3 package",
+    )
+    parser.add_argument(
+        "--checksum-cache",
+        dest="checksum_cache",
+        default=None,
+        help="SQLite file to cache the checksums of local files in. "
+        "Files that haven't changed since their checksum was cached are not hashed again",
+    )
+    parser.add_argument(
+        "-v",
+        dest="verbose",
+        action="store_true",
+        help="Verbose mode: print a message for every file",
+    )
     parser.add_argument(
         dest="source", help="The path of the directory you want to upload"
     )
     parser.add_argument(dest="destination", help="The destination in iRODS")
     args = parser.parse_args()
+    if args.hash_algorithm == "blake3" and blake3 is None:
+        parser.error("--hash-algorithm blake3 requires the blake3 package")
 
-    # Create an iRODS session
-    try:
-        env_file = os.environ["IRODS_ENVIRONMENT_FILE"]
-    except KeyError:
-        env_file = os.path.expanduser("~/.irods/irods_environment.json")
-    ssl_context = ssl.create_default_context(
-        purpose=ssl.Purpose.SERVER_AUTH, cafile=None, capath=None, cadata=None
-    )
-    ssl_settings = {"ssl_context": ssl_context}
+    logging.basicConfig(format="%(message)s")
+    # only this script's messages, not the debug output of the iRODS client
+    logger.setLevel(logging.DEBUG if args.verbose else logging.WARNING)
 
-    with iRODSSession(irods_env_file=env_file, **ssl_settings) as session:
+    # Create an iRODS session
+    with make_session() as session:
+        # one connection per worker, reused for all files
+        warm_up_pool(session, args.concurrency + LARGE_FILE_WORKERS)
 
         metadata_methods = []
         if args.preserve_mtime:
             metadata_methods.append(create_modify_time_avu)
             print("Adding mtime as metadata")
-        # synchronize data to iRODS
-        results = sync_directory(
-            session,
-            args.source,
-            args.destination,
-            args.verification,
-            args.post_check,
-            metadata_methods,
+        state = load_sync_state(args.state_file) if args.state_file else None
+        if args.resume_log:
+            state = state if state is not None else {}
+            state.update(load_log_state(args.resume_log))
+        checksum_cache = (
+            ChecksumCache(args.checksum_cache) if args.checksum_cache else None
         )
-        # report in file and in standard output
-        write_results_to_log(results)
+        # synchronize data to iRODS, logging every file as it's done
+        log = open_log()
+        try:
+            results = sync_directory(
+                session,
+                args.source,
+                args.destination,
+                args.verification,
+                args.post_check,
+                metadata_methods,
+                max_workers=args.concurrency,
+                state=state,
+                checksum_cache=checksum_cache,
+                large_file_threshold=args.large_file_threshold,
+                directory_digests=args.directory_digests,
+                hash_algorithm=args.hash_algorithm,
+                log=log,
+            )
+            # the totals go on the last line
+            log.write(json.dumps(results) + "\n")
+        finally:
+            log.close()
+            if checksum_cache is not None:
+                checksum_cache.close()
+        if args.state_file:
+            write_sync_state(state, args.state_file)
+        # report in standard output
         summarize(args.source, args.destination, results)
@@ -1,10 +1,8 @@
 """Upload a directory to iRODS"""
 
 import os
-import ssl
-from pathlib import Path
-from irods.session import iRODSSession
 from argparse import ArgumentParser
+from _session import make_session
 
 
 def upload_directory(session, source, destination):
@@ -26,24 +24,31 @@ def upload_directory(session, source, destination):
         Please provide a full path.
     """
 
-    # create a collection for the current directory
-    # If the collection already exists, iRODS doesn't complain
-    directory = Path(source)
-    collection = f"{destination}/{directory.name}"
-    print(f"Creating collection {collection}")
-    session.collections.create(collection)
+    # directories still to upload, with the collection to upload them to
+    stack = [(source, destination)]
+    while stack:
+        path, parent = stack.pop()
 
-    # upload all files in the directory
-    files = [f for f in directory.iterdir() if f.is_file()]
-    for file in files:
-        print(f"Uploading {file}.")
-        data_object = f"{collection}/{file.name}"
-        session.data_objects.put(file, data_object)
+        # create a collection for the current directory
+        # If the collection already exists, iRODS doesn't complain
+        collection = f"{parent}/{os.path.basename(os.path.normpath(path))}"
+        print(f"Creating collection {collection}")
+        session.collections.create(collection)
 
-    # for all subdirectories, run this function again
-    subdirs = [d for d in directory.iterdir() if d.is_dir()]
-    for subdir in subdirs:
-        upload_directory(session, subdir, collection)
+        # list the directory once; the entries cache whether they're a file or directory
+        with os.scandir(path) as it:
+            entries = list(it)
+
+        # upload all files in the directory
+        prefix = collection + "/"
+        files = [f for f in entries if f.is_file()]
+        for file in files:
+            print(f"Uploading {file.path}.")
+            data_object = prefix + file.name
+            session.data_objects.put(file.path, data_object)
+
+        # upload all subdirectories in later iterations
+        stack.extend((d.path, collection) for d in entries if d.is_dir())
 
 
 if __name__ == '__main__':
@@ -59,16 +64,6 @@ if __name__ == '__main__':
     destination = args.destination
 
     # Create an iRODS session
-    try:
-        env_file = os.environ['IRODS_ENVIRONMENT_FILE']
-    except KeyError:
-        env_file = os.path.expanduser('~/.irods/irods_environment.json')
-
-    ssl_context = ssl.create_default_context(purpose=ssl.Purpose.SERVER_AUTH,
-                                             cafile=None,
-                                             capath=None,
-                                             cadata=None)
-    ssl_settings = {'ssl_context': ssl_context}
-    with iRODSSession(irods_env_file=env_file, **ssl_settings) as session:
+    with make_session() as session:
 
         upload_directory(session, source, destination)